@@ -40,12 +40,12 @@ if ! bazel; then
   PATH="$HOME/bin:$PATH"
 fi
 
-# Run all deepvariant tests.  Take bazel options from args, if any.
+# Run all deepvariant and scripts tests.  Take bazel options from args, if any.
 # Note: If running with GPU, tests must be executed serially due to a GPU
 # contention issue.
 if [[ "${DV_GPU_BUILD:-0}" = "1" ]]; then
   bazel test -c opt --local_test_jobs=1 ${DV_COPT_FLAGS} "$@" \
-    deepvariant/...
+    deepvariant/... scripts/...
   # GPU tests are commented out for now.
   # Because they seem to be all filtered out, and as a result causing an error.
   # See internal#comment5.
@@ -54,7 +54,7 @@ if [[ "${DV_GPU_BUILD:-0}" = "1" ]]; then
   #   deepvariant:gpu_tests
 else
   # Running parallel tests on CPU.
-  bazel test -c opt ${DV_COPT_FLAGS} "$@" deepvariant/...
+  bazel test -c opt ${DV_COPT_FLAGS} "$@" deepvariant/... scripts/...
 fi
 
 # Build the binary.
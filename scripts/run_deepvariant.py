@@ -37,10 +37,17 @@ For more details, see:
 https://github.com/google/deepvariant/blob/r1.0/docs/deepvariant-quick-start.md
 """
 
+import collections
+from concurrent import futures
+import contextlib
+import json
 import os
+import resource
+import shlex
 import subprocess
 import sys
 import tempfile
+import time
 
 from absl import app
 from absl import flags
@@ -71,6 +78,24 @@ flags.DEFINE_string(
     'Optional. If specified, this should be an existing '
     'directory that is visible insider docker, and will be '
     'used to to store intermediate outputs.')
+flags.DEFINE_enum(
+    'intermediate_compression', 'gzip', ['gzip', 'none'],
+    'Optional. Compression of the intermediate TFRecord files. "none" writes '
+    'them uncompressed, which saves CPU time in make_examples and '
+    'call_variants but takes several times more space in '
+    '--intermediate_results_dir.')
+flags.DEFINE_boolean(
+    'dry_run', False,
+    'Optional. If true, print the commands to be executed, one per line, and '
+    'exit without running them. Requires --intermediate_results_dir, which is '
+    'used in the printed commands but not created.')
+flags.DEFINE_boolean(
+    'emit_plan_json', False,
+    'Optional. If true, print the pipeline as a JSON list of steps and exit '
+    'without running it. Each step has a name, the commands to run in '
+    'parallel, the steps it depends on, and its input and output files. '
+    'Requires --intermediate_results_dir, which is used in the plan but not '
+    'created.')
 flags.DEFINE_boolean(
     'version',
     None,
@@ -82,8 +107,17 @@ flags.DEFINE_string(
     'Optional. A path to a model checkpoint to load for the `call_variants` '
     'step. If not set, the default for each --model_type will be used')
 # Optional flags for make_examples.
-flags.DEFINE_integer('num_shards', 1,
-                     'Optional. Number of shards for make_examples step.')
+flags.DEFINE_integer(
+    'num_shards', None,
+    'Optional. Number of shards for make_examples step. If not set, one shard '
+    'is used per CPU available to this process, as long as there is enough '
+    'memory for all of them.',
+    lower_bound=1)
+flags.DEFINE_boolean(
+    'pin_make_examples_shards', False,
+    'Optional. If true, each make_examples shard is pinned to its own subset '
+    'of the CPUs available to this process with taskset, so the shards are '
+    'not moved between CPUs (and NUMA nodes) while they run.')
 flags.DEFINE_string(
     'regions', None,
     'Optional. Space-separated list of regions we want to process. Elements '
@@ -97,17 +131,20 @@ flags.DEFINE_string(
     'make_examples_extra_args', None,
     'A comma-separated list of flag_name=flag_value. "flag_name" has to be '
     'valid flags for make_examples.py. If the flag_value is boolean, it has to '
-    'be flag_name=true or flag_name=false.')
+    'be flag_name=true or flag_name=false. A flag_value wrapped in single or '
+    'double quotes is passed without the quotes.')
 flags.DEFINE_string(
     'call_variants_extra_args', None,
     'A comma-separated list of flag_name=flag_value. "flag_name" has to be '
     'valid flags for call_variants.py. If the flag_value is boolean, it has to '
-    'be flag_name=true or flag_name=false.')
+    'be flag_name=true or flag_name=false. A flag_value wrapped in single or '
+    'double quotes is passed without the quotes.')
 flags.DEFINE_string(
     'postprocess_variants_extra_args', None,
     'A comma-separated list of flag_name=flag_value. "flag_name" has to be '
     'valid flags for calpostprocess_variants.py. If the flag_value is boolean, '
-    'it has to be flag_name=true or flag_name=false.')
+    'it has to be flag_name=true or flag_name=false. A flag_value wrapped in '
+    'single or double quotes is passed without the quotes.')
 
 # Optional flags for postprocess_variants.
 flags.DEFINE_string('output_gvcf', None,
@@ -127,19 +164,22 @@ MODEL_TYPE_MAP = {
 # Should be the same in dv_vcf_constants.py.
 DEEP_VARIANT_VERSION = '1.0.0'
 
+# Memory needed by each make_examples shard. The case studies run 64 shards on
+# a 64-core machine with 128GiB of memory.
+_MEMORY_BYTES_PER_SHARD = 2 * 1024**3
 
-def _is_quoted(value):
-  if value.startswith('"') and value.endswith('"'):
-    return True
-  if value.startswith("'") and value.endswith("'"):
-    return True
-  return False
+# Files that hold the memory limit of the cgroup (v2 and v1) we are running in.
+_CGROUP_MEMORY_LIMIT_FILES = [
+    '/sys/fs/cgroup/memory.max',
+    '/sys/fs/cgroup/memory/memory.limit_in_bytes',
+]
 
+# File extensions of the intermediate TFRecord files for each value of
+# --intermediate_compression.
+_INTERMEDIATE_COMPRESSION_SUFFIX = {'gzip': '.gz', 'none': ''}
 
-def _add_quotes(value):
-  if isinstance(value, str) and _is_quoted(value):
-    return value
-  return '"{}"'.format(value)
+# Values in *_extra_args that are converted to booleans.
+_BOOLEAN_FLAG_VALUES = {'true': True, 'false': False}
 
 
 def _extra_args_to_dict(extra_args):
@@ -148,42 +188,60 @@ def _extra_args_to_dict(extra_args):
   if extra_args is None:
     return args_dict
   for extra_arg in extra_args.split(','):
-    (flag_name, flag_value) = extra_arg.split('=')
+    # Only split on the first '=', so flag values can contain '='.
+    flag_name, separator, flag_value = extra_arg.partition('=')
+    if not separator:
+      raise ValueError(
+          'Expected flag_name=flag_value in extra args, got "{}".'.format(
+              extra_arg))
     # Check for boolean values.
-    if flag_value.lower() == 'true':
-      flag_value = True
-    elif flag_value.lower() == 'false':
-      flag_value = False
-    args_dict[flag_name] = flag_value
+    args_dict[flag_name] = _BOOLEAN_FLAG_VALUES.get(flag_value.lower(),
+                                                    flag_value)
   return args_dict
 
 
+def _strip_quotes(value):
+  """Removes one layer of matching single or double quotes around `value`.
+
+  Commands used to go through bash, which removed these quotes. Users still
+  pass values like regions='chr1 chr2' in the *_extra_args flags.
+  """
+  if len(value) >= 2 and value[0] == value[-1] and value[0] in ('"', "'"):
+    return value[1:-1]
+  return value
+
+
 def _extend_command_by_args_dict(command, extra_args):
-  """Adds `extra_args` to the command string."""
+  """Adds `extra_args` to the command's list of arguments."""
+  added_args = []
   for key in sorted(extra_args):
     value = extra_args[key]
     if value is None:
       continue
     if isinstance(value, bool):
-      added_arg = '' if value else 'no'
-      added_arg += key
-      command.extend(['--' + added_arg])
+      added_args.append(('--' if value else '--no') + key)
     else:
-      command.extend(['--' + key, _add_quotes(value)])
+      added_args.append('--' + key)
+      added_args.append(_strip_quotes(str(value)))
+  command.extend(added_args)
   return command
 
 
 def _update_kwargs_with_warning(kwargs, extra_args):
   for k, v in extra_args.items():
     if k in kwargs:
-      print('\nWarning: --{} is previously set to {}, now to {}.'.format(
-          k, kwargs[k], v))
+      # Logged to stderr, so --dry_run and --emit_plan_json keep stdout clean.
+      logging.warning('--%s is previously set to %s, now to %s.', k,
+                      kwargs[k], v)
     kwargs[k] = v
   return kwargs
 
 
 def make_examples_command(ref, reads, examples, extra_args, **kwargs):
-  """Returns a make_examples command for subprocess.check_call.
+  """Returns a make_examples command as a list of arguments.
+
+  The command doesn't include --task. Use shard_commands to get one command
+  for each shard.
 
   Args:
     ref: Input FASTA file.
@@ -193,16 +251,13 @@ def make_examples_command(ref, reads, examples, extra_args, **kwargs):
     **kwargs: Additional arguments to pass in for make_examples.
 
   Returns:
-    (string) A command to run.
+    (list) A command to run, shared by all shards.
   """
-  command = [
-      'time', 'seq 0 {} |'.format(FLAGS.num_shards - 1),
-      'parallel -q --halt 2 --line-buffer', '/opt/deepvariant/bin/make_examples'
-  ]
+  command = ['/opt/deepvariant/bin/make_examples']
   command.extend(['--mode', 'calling'])
-  command.extend(['--ref', '"{}"'.format(ref)])
-  command.extend(['--reads', '"{}"'.format(reads)])
-  command.extend(['--examples', '"{}"'.format(examples)])
+  command.extend(['--ref', ref])
+  command.extend(['--reads', reads])
+  command.extend(['--examples', examples])
   if FLAGS.model_type == 'PACBIO':
     special_args = {}
     special_args['realign_reads'] = False
@@ -213,21 +268,24 @@ def make_examples_command(ref, reads, examples, extra_args, **kwargs):
   # Extend the command with all items in kwargs and extra_args.
   kwargs = _update_kwargs_with_warning(kwargs, _extra_args_to_dict(extra_args))
   command = _extend_command_by_args_dict(command, kwargs)
+  return command
 
-  command.extend(['--task {}'])
-  return ' '.join(command)
+
+def shard_commands(command, num_shards):
+  """Returns one copy of `command` per shard, each with its own --task."""
+  return [command + ['--task', str(task)] for task in range(num_shards)]
 
 
 def call_variants_command(outfile, examples, model_ckpt, extra_args):
-  """Returns a call_variants command for subprocess.check_call."""
-  command = ['time', '/opt/deepvariant/bin/call_variants']
-  command.extend(['--outfile', '"{}"'.format(outfile)])
-  command.extend(['--examples', '"{}"'.format(examples)])
-  command.extend(['--checkpoint', '"{}"'.format(model_ckpt)])
+  """Returns a call_variants command as a list of arguments."""
+  command = ['/opt/deepvariant/bin/call_variants']
+  command.extend(['--outfile', outfile])
+  command.extend(['--examples', examples])
+  command.extend(['--checkpoint', model_ckpt])
   # Extend the command with all items in extra_args.
   command = _extend_command_by_args_dict(command,
                                          _extra_args_to_dict(extra_args))
-  return ' '.join(command)
+  return command
 
 
 def postprocess_variants_command(ref,
@@ -238,44 +296,126 @@ def postprocess_variants_command(ref,
                                  gvcf_outfile=None,
                                  vcf_stats_report=True,
                                  sample_name=None):
-  """Returns a postprocess_variants command for subprocess.check_call."""
-  command = ['time', '/opt/deepvariant/bin/postprocess_variants']
-  command.extend(['--ref', '"{}"'.format(ref)])
-  command.extend(['--infile', '"{}"'.format(infile)])
-  command.extend(['--outfile', '"{}"'.format(outfile)])
+  """Returns a postprocess_variants command as a list of arguments."""
+  command = ['/opt/deepvariant/bin/postprocess_variants']
+  command.extend(['--ref', ref])
+  command.extend(['--infile', infile])
+  command.extend(['--outfile', outfile])
   if nonvariant_site_tfrecord_path is not None:
-    command.extend([
-        '--nonvariant_site_tfrecord_path',
-        '"{}"'.format(nonvariant_site_tfrecord_path)
-    ])
+    command.extend(
+        ['--nonvariant_site_tfrecord_path', nonvariant_site_tfrecord_path])
   if gvcf_outfile is not None:
-    command.extend(['--gvcf_outfile', '"{}"'.format(gvcf_outfile)])
+    command.extend(['--gvcf_outfile', gvcf_outfile])
   if not vcf_stats_report:
     command.extend(['--novcf_stats_report'])
   if sample_name is not None:
-    command.extend(['--sample_name', '"{}"'.format(sample_name)])
+    command.extend(['--sample_name', sample_name])
   # Extend the command with all items in extra_args.
   command = _extend_command_by_args_dict(command,
                                          _extra_args_to_dict(extra_args))
-  return ' '.join(command)
+  return command
+
+
+def pin_commands_to_cpus(commands):
+  """Prefixes each command so that it only runs on its own CPUs.
+
+  The CPUs available to this process are split into contiguous blocks, one per
+  command. If there are more commands than CPUs, neighboring commands share a
+  CPU. The commands are prefixed with taskset, which only sets the CPU
+  affinity and needs no extra privileges inside containers.
+
+  Args:
+    commands: list. Each element is a list of arguments.
+
+  Returns:
+    (list) The prefixed commands.
+  """
+  cpus = sorted(os.sched_getaffinity(0))
+  pinned_commands = []
+  for i, command in enumerate(commands):
+    start = i * len(cpus) // len(commands)
+    end = max(start + 1, (i + 1) * len(cpus) // len(commands))
+    cpu_list = ','.join(str(cpu) for cpu in cpus[start:end])
+    pinned_commands.append(['taskset', '--cpu-list', cpu_list] + command)
+  return pinned_commands
 
 
 def check_or_create_intermediate_results_dir(intermediate_results_dir):
   """Checks or creates the path to the directory for intermediate results."""
-  if intermediate_results_dir is None:
-    intermediate_results_dir = tempfile.mkdtemp()
-  if not os.path.isdir(intermediate_results_dir):
-    logging.info('Creating a directory for intermediate results in %s',
-                 intermediate_results_dir)
-    os.makedirs(intermediate_results_dir)
-  else:
-    logging.info('Re-using the directory for intermediate results in %s',
-                 intermediate_results_dir)
+  os.makedirs(intermediate_results_dir, exist_ok=True)
+  logging.info('Using the directory for intermediate results in %s',
+               intermediate_results_dir)
   return intermediate_results_dir
 
 
+def _get_available_memory():
+  """Returns the physical memory in bytes, capped by the cgroup limit."""
+  memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+  for limit_file in _CGROUP_MEMORY_LIMIT_FILES:
+    try:
+      with open(limit_file) as f:
+        limit = f.read().strip()
+    except (IOError, OSError):
+      continue
+    # cgroup v2 writes 'max' when there is no limit.
+    if limit.isdigit():
+      memory = min(memory, int(limit))
+  return memory
+
+
+def get_default_num_shards():
+  """Returns the number of make_examples shards that the machine can run.
+
+  Unlike os.cpu_count, os.sched_getaffinity respects the CPUs given to a
+  container with --cpuset-cpus or to the process with taskset.
+  """
+  num_cpus = len(os.sched_getaffinity(0))
+  num_shards_in_memory = _get_available_memory() // _MEMORY_BYTES_PER_SHARD
+  return max(1, min(num_cpus, num_shards_in_memory))
+
+
+def _get_reads_index_paths(reads):
+  """Returns the paths where htslib looks for the index of `reads`."""
+  extensions = ['.crai'] if reads.endswith('.cram') else ['.bai', '.csi']
+  base = os.path.splitext(reads)[0]
+  return ([reads + ext for ext in extensions] +
+          [base + ext for ext in extensions])
+
+
+def find_missing_inputs(ref, reads):
+  """Returns error messages for input files or indices that don't exist."""
+  errors = []
+  if not os.path.exists(ref):
+    errors.append('--ref {} does not exist.'.format(ref))
+  elif not os.path.exists(ref + '.fai'):
+    errors.append('--ref {} has no FAI index at {}.fai.'.format(ref, ref))
+  if not os.path.exists(reads):
+    errors.append('--reads {} does not exist.'.format(reads))
+  else:
+    index_paths = _get_reads_index_paths(reads)
+    if not any(os.path.exists(path) for path in index_paths):
+      errors.append('--reads {} has no index. Looked for: {}.'.format(
+          reads, ', '.join(index_paths)))
+  return errors
+
+
 def check_flags():
   """Additional logic to make sure flags are set appropriately."""
+  # Fail before starting any shard, rather than in every shard. The inputs
+  # don't need to exist yet when we only print the commands.
+  if FLAGS.dry_run or FLAGS.emit_plan_json:
+    errors = []
+  else:
+    errors = find_missing_inputs(FLAGS.ref, FLAGS.reads)
+  if errors:
+    for error in errors:
+      sys.stderr.write(error + '\n')
+    sys.exit(1)
+  if FLAGS.num_shards is None:
+    FLAGS.num_shards = get_default_num_shards()
+    logging.info(
+        '--num_shards is not set. Using %d shards based on the CPUs and '
+        'memory available.', FLAGS.num_shards)
   if FLAGS.customized_model is not None:
     logging.info(
         'You set --customized_model. Instead of using the default '
@@ -291,51 +431,157 @@ def get_model_ckpt(model_type, customized_model):
     return MODEL_TYPE_MAP[model_type]
 
 
+# One step of the pipeline. `commands` are run in parallel, each as a list of
+# arguments. A step can start once all steps in `depends_on` have finished.
+# `inputs` and `outputs` are the files the step reads and writes.
+PipelineStep = collections.namedtuple(
+    'PipelineStep', ['name', 'commands', 'depends_on', 'inputs', 'outputs'])
+
+
 def create_all_commands(intermediate_results_dir):
-  """Creates 3 commands to be executed later."""
-  commands = []
+  """Creates the 3 steps to be executed later.
+
+  Args:
+    intermediate_results_dir: str. Directory for the intermediate outputs.
+
+  Returns:
+    (list) PipelineSteps, in an order that satisfies their dependencies.
+  """
+  steps = []
+  # The binaries pick the TFRecord compression based on the file extension.
+  suffix = _INTERMEDIATE_COMPRESSION_SUFFIX[FLAGS.intermediate_compression]
   # make_examples
   nonvariant_site_tfrecord_path = None
   if FLAGS.output_gvcf is not None:
     nonvariant_site_tfrecord_path = os.path.join(
         intermediate_results_dir,
-        'gvcf.tfrecord@{}.gz'.format(FLAGS.num_shards))
+        'gvcf.tfrecord@{}{}'.format(FLAGS.num_shards, suffix))
 
   examples = os.path.join(
       intermediate_results_dir,
-      'make_examples.tfrecord@{}.gz'.format(FLAGS.num_shards))
-
-  commands.append(
-      make_examples_command(
-          FLAGS.ref,
-          FLAGS.reads,
-          examples,
-          FLAGS.make_examples_extra_args,
-          gvcf=nonvariant_site_tfrecord_path,
-          regions=FLAGS.regions,
-          sample_name=FLAGS.sample_name))
+      'make_examples.tfrecord@{}{}'.format(FLAGS.num_shards, suffix))
+
+  # The shared arguments are only built once, then each shard adds --task.
+  make_examples = make_examples_command(
+      FLAGS.ref,
+      FLAGS.reads,
+      examples,
+      FLAGS.make_examples_extra_args,
+      gvcf=nonvariant_site_tfrecord_path,
+      regions=FLAGS.regions,
+      sample_name=FLAGS.sample_name)
+  make_examples_commands = shard_commands(make_examples, FLAGS.num_shards)
+  if FLAGS.pin_make_examples_shards:
+    make_examples_commands = pin_commands_to_cpus(make_examples_commands)
+  steps.append(
+      PipelineStep(
+          name='make_examples',
+          commands=make_examples_commands,
+          depends_on=[],
+          inputs=[FLAGS.ref, FLAGS.reads],
+          outputs=[examples, nonvariant_site_tfrecord_path]))
 
   # call_variants
-  call_variants_output = os.path.join(intermediate_results_dir,
-                                      'call_variants_output.tfrecord.gz')
+  call_variants_output = os.path.join(
+      intermediate_results_dir, 'call_variants_output.tfrecord' + suffix)
   model_ckpt = get_model_ckpt(FLAGS.model_type, FLAGS.customized_model)
-  commands.append(
-      call_variants_command(call_variants_output, examples, model_ckpt,
-                            FLAGS.call_variants_extra_args))
+  steps.append(
+      PipelineStep(
+          name='call_variants',
+          commands=[
+              call_variants_command(call_variants_output, examples, model_ckpt,
+                                    FLAGS.call_variants_extra_args)
+          ],
+          depends_on=['make_examples'],
+          inputs=[examples, model_ckpt],
+          outputs=[call_variants_output]))
 
   # postprocess_variants
-  commands.append(
-      postprocess_variants_command(
-          FLAGS.ref,
-          call_variants_output,
-          FLAGS.output_vcf,
-          FLAGS.postprocess_variants_extra_args,
-          nonvariant_site_tfrecord_path=nonvariant_site_tfrecord_path,
-          gvcf_outfile=FLAGS.output_gvcf,
-          vcf_stats_report=FLAGS.vcf_stats_report,
-          sample_name=FLAGS.sample_name))
+  steps.append(
+      PipelineStep(
+          name='postprocess_variants',
+          commands=[
+              postprocess_variants_command(
+                  FLAGS.ref,
+                  call_variants_output,
+                  FLAGS.output_vcf,
+                  FLAGS.postprocess_variants_extra_args,
+                  nonvariant_site_tfrecord_path=nonvariant_site_tfrecord_path,
+                  gvcf_outfile=FLAGS.output_gvcf,
+                  vcf_stats_report=FLAGS.vcf_stats_report,
+                  sample_name=FLAGS.sample_name)
+          ],
+          depends_on=['call_variants'],
+          inputs=[FLAGS.ref, call_variants_output,
+                  nonvariant_site_tfrecord_path],
+          outputs=[FLAGS.output_vcf, FLAGS.output_gvcf]))
+
+  # Drop the optional files that are not used in this run.
+  return [
+      step._replace(
+          inputs=[path for path in step.inputs if path is not None],
+          outputs=[path for path in step.outputs if path is not None])
+      for step in steps
+  ]
+
+
+def _command_to_string(command):
+  """Formats a list of arguments as a command that can be pasted in a shell."""
+  return ' '.join(shlex.quote(arg) for arg in command)
 
-  return commands
+
+def run_commands_in_parallel(commands):
+  """Runs each command in its own process and waits for all of them.
+
+  If any of the processes fails, the remaining ones are terminated, similar to
+  `parallel --halt 2`.
+
+  Args:
+    commands: list. Each element is a list of arguments for subprocess.Popen.
+
+  Raises:
+    subprocess.CalledProcessError: If any of the commands exits with a non-zero
+      status.
+  """
+  processes = []
+  executor = futures.ThreadPoolExecutor(max_workers=len(commands))
+  try:
+    # Start the processes one by one, so that the ones already running are
+    # cleaned up below if a later one fails to start.
+    for command in commands:
+      processes.append(subprocess.Popen(command))
+    waits = {executor.submit(p.wait): p for p in processes}
+    for done in futures.as_completed(waits):
+      returncode = done.result()
+      if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, waits[done].args)
+  finally:
+    for process in processes:
+      if process.poll() is None:
+        process.terminate()
+    for process in processes:
+      process.wait()
+    executor.shutdown()
+
+
+def run_step(step):
+  """Runs the commands of a PipelineStep and logs how long they took."""
+  print('\n***** Running the command:*****\n{}\n'.format('\n'.join(
+      _command_to_string(command) for command in step.commands)))
+  start_time = time.perf_counter()
+  start_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  run_commands_in_parallel(step.commands)
+  end_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  # Same numbers as the `time` shell keyword reports, in a format that is
+  # easy to parse from the logs.
+  logging.info(
+      'Timing: %s',
+      json.dumps({
+          'step': step.name,
+          'real': round(time.perf_counter() - start_time, 3),
+          'user': round(end_usage.ru_utime - start_usage.ru_utime, 3),
+          'sys': round(end_usage.ru_stime - start_usage.ru_stime, 3),
+      }))
 
 
 def main(_):
@@ -343,26 +589,51 @@ def main(_):
     print('DeepVariant version {}'.format(DEEP_VARIANT_VERSION))
     return
 
-  for flag_key in ['model_type', 'ref', 'reads', 'output_vcf']:
-    if FLAGS.get_flag_value(flag_key, None) is None:
+  missing_flags = [
+      flag_key for flag_key in ['model_type', 'ref', 'reads', 'output_vcf']
+      if getattr(FLAGS, flag_key) is None
+  ]
+  if missing_flags:
+    for flag_key in missing_flags:
       sys.stderr.write('--{} is required.\n'.format(flag_key))
-      sys.stderr.write('Pass --helpshort or --helpfull to see help on flags.\n')
-      sys.exit(1)
+    sys.stderr.write('Pass --helpshort or --helpfull to see help on flags.\n')
+    sys.exit(1)
+  plan_only = FLAGS.dry_run or FLAGS.emit_plan_json
+  if plan_only and FLAGS.intermediate_results_dir is None:
+    # A temporary directory would be deleted before the commands are run.
+    sys.stderr.write('--intermediate_results_dir is required with '
+                     '--dry_run and --emit_plan_json.\n')
+    sys.exit(1)
 
-  intermediate_results_dir = check_or_create_intermediate_results_dir(
-      FLAGS.intermediate_results_dir)
   check_flags()
 
-  commands = create_all_commands(intermediate_results_dir)
-  print('\n***** Intermediate results will be written to {} '
-        'in docker. ****\n'.format(intermediate_results_dir))
-  for command in commands:
-    print('\n***** Running the command:*****\n{}\n'.format(command))
-    try:
-      subprocess.check_call(command, shell=True, executable='/bin/bash')
-    except subprocess.CalledProcessError as e:
-      logging.info(e.output)
-      raise
+  with contextlib.ExitStack() as stack:
+    if FLAGS.intermediate_results_dir is None:
+      # Without --intermediate_results_dir, the intermediate results are only
+      # kept until the run finishes.
+      intermediate_results_dir = stack.enter_context(
+          tempfile.TemporaryDirectory())
+    elif plan_only:
+      # The directory is only created when the commands are run.
+      intermediate_results_dir = FLAGS.intermediate_results_dir
+    else:
+      intermediate_results_dir = check_or_create_intermediate_results_dir(
+          FLAGS.intermediate_results_dir)
+
+    steps = create_all_commands(intermediate_results_dir)
+    if FLAGS.emit_plan_json:
+      print(json.dumps([step._asdict() for step in steps], indent=2))
+      return
+    if FLAGS.dry_run:
+      for step in steps:
+        for command in step.commands:
+          print(_command_to_string(command))
+      return
+    print('\n***** Intermediate results will be written to {} '
+          'in docker. ****\n'.format(intermediate_results_dir))
+    # The steps depend on each other in a chain, so they run in order.
+    for step in steps:
+      run_step(step)
 
 
 if __name__ == '__main__':
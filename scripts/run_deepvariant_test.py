@@ -0,0 +1,419 @@
+# Copyright 2020 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for scripts.run_deepvariant."""
+
+import io
+import json
+import os
+import shlex
+import signal
+import subprocess
+import sys
+
+from absl import flags
+from absl.testing import absltest
+from absl.testing import flagsaver
+import mock
+
+from scripts import run_deepvariant
+
+FLAGS = flags.FLAGS
+
+
+def _run_main(**flag_values):
+  """Runs run_deepvariant.main with `flag_values` and returns its stdout."""
+  with flagsaver.flagsaver(**flag_values):
+    with mock.patch.object(sys, 'stdout', new_callable=io.StringIO) as stdout:
+      run_deepvariant.main([])
+  return stdout.getvalue()
+
+
+class RunCommandsInParallelTest(absltest.TestCase):
+
+  def setUp(self):
+    super(RunCommandsInParallelTest, self).setUp()
+    # Keep track of every process started, to check none is left running.
+    self.processes = []
+    popen = subprocess.Popen
+
+    def record_popen(command):
+      process = popen(command)
+      self.processes.append(process)
+      return process
+
+    patcher = mock.patch.object(subprocess, 'Popen', side_effect=record_popen)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_all_commands_succeed(self):
+    run_deepvariant.run_commands_in_parallel([['true'], ['true'], ['true']])
+    self.assertEqual([p.returncode for p in self.processes], [0, 0, 0])
+
+  def test_failing_command_terminates_the_others(self):
+    with self.assertRaises(subprocess.CalledProcessError) as cm:
+      run_deepvariant.run_commands_in_parallel([['sleep', '77'],
+                                                ['sh', '-c', 'exit 3']])
+    self.assertEqual(cm.exception.returncode, 3)
+    self.assertEqual(cm.exception.cmd, ['sh', '-c', 'exit 3'])
+    self.assertEqual(self.processes[0].returncode, -signal.SIGTERM)
+
+  def test_failing_to_start_a_command_terminates_the_others(self):
+    with self.assertRaises(OSError):
+      run_deepvariant.run_commands_in_parallel([['sleep', '77'],
+                                                ['/nonexistent/bin']])
+    self.assertLen(self.processes, 1)
+    self.assertEqual(self.processes[0].returncode, -signal.SIGTERM)
+
+
+class GetDefaultNumShardsTest(absltest.TestCase):
+
+  _GB = 1024**3
+
+  def _get_default_num_shards(self, num_cpus, memory, cgroup_limits=()):
+    """Returns the default with `num_cpus`, `memory` and cgroup files."""
+    limit_files = []
+    for limit in cgroup_limits:
+      limit_files.append(self.create_tempfile(content=limit).full_path)
+    limit_files.append(os.path.join(self.create_tempdir().full_path, 'none'))
+    sysconf = {'SC_PAGE_SIZE': 4096, 'SC_PHYS_PAGES': memory // 4096}
+    with mock.patch.object(
+        os, 'sched_getaffinity', return_value=set(range(num_cpus))), \
+        mock.patch.object(os, 'sysconf', side_effect=sysconf.get), \
+        mock.patch.object(run_deepvariant, '_CGROUP_MEMORY_LIMIT_FILES',
+                          limit_files):
+      return run_deepvariant.get_default_num_shards()
+
+  def test_capped_by_cpus(self):
+    self.assertEqual(self._get_default_num_shards(4, 64 * self._GB), 4)
+
+  def test_capped_by_memory(self):
+    self.assertEqual(self._get_default_num_shards(64, 9 * self._GB), 4)
+
+  def test_at_least_one_shard(self):
+    self.assertEqual(self._get_default_num_shards(8, self._GB), 1)
+
+  def test_cgroup_v2_max_is_ignored(self):
+    self.assertEqual(
+        self._get_default_num_shards(64, 16 * self._GB, ['max\n']), 8)
+
+  def test_capped_by_cgroup_limit_below_physical_memory(self):
+    self.assertEqual(
+        self._get_default_num_shards(64, 64 * self._GB,
+                                     [str(6 * self._GB) + '\n']), 3)
+
+
+class PinCommandsToCpusTest(absltest.TestCase):
+
+  @mock.patch.object(os, 'sched_getaffinity', return_value={0, 1, 2, 3})
+  def test_cpus_are_split_between_commands(self, _):
+    self.assertEqual(
+        run_deepvariant.pin_commands_to_cpus([['a'], ['b'], ['c']]), [
+            ['taskset', '--cpu-list', '0', 'a'],
+            ['taskset', '--cpu-list', '1', 'b'],
+            ['taskset', '--cpu-list', '2,3', 'c'],
+        ])
+
+  @mock.patch.object(os, 'sched_getaffinity', return_value={4, 5})
+  def test_more_commands_than_cpus(self, _):
+    pinned = run_deepvariant.pin_commands_to_cpus([['a'], ['b'], ['c']])
+    self.assertEqual([command[2] for command in pinned], ['4', '4', '5'])
+
+
+class ExtraArgsToDictTest(absltest.TestCase):
+
+  def test_none(self):
+    self.assertEqual(run_deepvariant._extra_args_to_dict(None), {})
+
+  def test_value_with_equal_sign(self):
+    self.assertEqual(
+        run_deepvariant._extra_args_to_dict('a=b=c'), {'a': 'b=c'})
+
+  def test_boolean_values(self):
+    self.assertEqual(
+        run_deepvariant._extra_args_to_dict('x=True,y=false,z=1'), {
+            'x': True,
+            'y': False,
+            'z': '1'
+        })
+
+  def test_missing_equal_sign(self):
+    with self.assertRaisesRegex(ValueError, 'flag_name=flag_value'):
+      run_deepvariant._extra_args_to_dict('a=1,b')
+
+
+class ExtendCommandByArgsDictTest(absltest.TestCase):
+
+  def test_flags_are_sorted_and_booleans_have_no_value(self):
+    self.assertEqual(
+        run_deepvariant._extend_command_by_args_dict(['cmd'], {
+            'b': 1,
+            'a': True,
+            'c': False,
+            'd': None
+        }), ['cmd', '--a', '--b', '1', '--noc'])
+
+  def test_one_layer_of_quotes_is_removed(self):
+    self.assertEqual(
+        run_deepvariant._extend_command_by_args_dict(
+            [], run_deepvariant._extra_args_to_dict(
+                'regions=\'chr1 chr2\',x="\'q\'",y="z')),
+        ['--regions', 'chr1 chr2', '--x', "'q'", '--y', '"z'])
+
+
+class ShardCommandsTest(absltest.TestCase):
+
+  def test_each_shard_gets_its_own_task(self):
+    command = ['make_examples', '--ref', 'ref.fa']
+    self.assertEqual(
+        run_deepvariant.shard_commands(command, 3), [
+            ['make_examples', '--ref', 'ref.fa', '--task', '0'],
+            ['make_examples', '--ref', 'ref.fa', '--task', '1'],
+            ['make_examples', '--ref', 'ref.fa', '--task', '2'],
+        ])
+    # The shared command is not modified.
+    self.assertEqual(command, ['make_examples', '--ref', 'ref.fa'])
+
+
+class CreateAllCommandsTest(absltest.TestCase):
+
+  _FLAG_VALUES = dict(
+      model_type='WGS',
+      ref='ref.fa',
+      reads='reads.bam',
+      output_vcf='out.vcf',
+      num_shards=2)
+
+  def test_steps_without_gvcf(self):
+    with flagsaver.flagsaver(**self._FLAG_VALUES):
+      steps = run_deepvariant.create_all_commands('/tmp/dv')
+    self.assertEqual([step.name for step in steps],
+                     ['make_examples', 'call_variants', 'postprocess_variants'])
+    self.assertEqual([step.depends_on for step in steps],
+                     [[], ['make_examples'], ['call_variants']])
+    self.assertEqual([step.inputs for step in steps], [
+        ['ref.fa', 'reads.bam'],
+        ['/tmp/dv/make_examples.tfrecord@2.gz', '/opt/models/wgs/model.ckpt'],
+        ['ref.fa', '/tmp/dv/call_variants_output.tfrecord.gz'],
+    ])
+    self.assertEqual([step.outputs for step in steps], [
+        ['/tmp/dv/make_examples.tfrecord@2.gz'],
+        ['/tmp/dv/call_variants_output.tfrecord.gz'],
+        ['out.vcf'],
+    ])
+    self.assertEqual([len(step.commands) for step in steps], [2, 1, 1])
+    self.assertNotIn('--gvcf', steps[0].commands[0])
+    self.assertNotIn('--nonvariant_site_tfrecord_path', steps[2].commands[0])
+
+  def test_steps_with_gvcf(self):
+    with flagsaver.flagsaver(output_gvcf='out.g.vcf', **self._FLAG_VALUES):
+      steps = run_deepvariant.create_all_commands('/tmp/dv')
+    gvcf_tfrecord = '/tmp/dv/gvcf.tfrecord@2.gz'
+    self.assertEqual(steps[0].outputs,
+                     ['/tmp/dv/make_examples.tfrecord@2.gz', gvcf_tfrecord])
+    self.assertEqual(steps[2].inputs, [
+        'ref.fa', '/tmp/dv/call_variants_output.tfrecord.gz', gvcf_tfrecord
+    ])
+    self.assertEqual(steps[2].outputs, ['out.vcf', 'out.g.vcf'])
+    make_examples = steps[0].commands[0]
+    self.assertEqual(make_examples[make_examples.index('--gvcf') + 1],
+                     gvcf_tfrecord)
+    postprocess = steps[2].commands[0]
+    self.assertEqual(
+        postprocess[postprocess.index('--nonvariant_site_tfrecord_path') + 1],
+        gvcf_tfrecord)
+    self.assertEqual(postprocess[postprocess.index('--gvcf_outfile') + 1],
+                     'out.g.vcf')
+
+  def test_uncompressed_intermediates(self):
+    with flagsaver.flagsaver(
+        output_gvcf='out.g.vcf',
+        intermediate_compression='none',
+        **self._FLAG_VALUES):
+      steps = run_deepvariant.create_all_commands('/tmp/dv')
+    self.assertEqual(steps[0].outputs, [
+        '/tmp/dv/make_examples.tfrecord@2', '/tmp/dv/gvcf.tfrecord@2'
+    ])
+    self.assertEqual(steps[1].outputs,
+                     ['/tmp/dv/call_variants_output.tfrecord'])
+
+
+class FindMissingInputsTest(absltest.TestCase):
+
+  def setUp(self):
+    super(FindMissingInputsTest, self).setUp()
+    self.tempdir = self.create_tempdir().full_path
+
+  def _touch(self, *names):
+    for name in names:
+      open(self._path(name), 'w').close()
+
+  def _path(self, name):
+    return os.path.join(self.tempdir, name)
+
+  def _find_missing_inputs(self, reads='x.bam'):
+    return run_deepvariant.find_missing_inputs(
+        self._path('ref.fa'), self._path(reads))
+
+  def test_all_inputs_exist(self):
+    self._touch('ref.fa', 'ref.fa.fai', 'x.bam', 'x.bam.bai')
+    self.assertEqual(self._find_missing_inputs(), [])
+
+  def test_missing_ref(self):
+    self._touch('x.bam', 'x.bam.bai')
+    errors = self._find_missing_inputs()
+    self.assertLen(errors, 1)
+    self.assertRegex(errors[0], r'--ref .*ref\.fa does not exist')
+
+  def test_missing_fai(self):
+    self._touch('ref.fa', 'x.bam', 'x.bam.bai')
+    errors = self._find_missing_inputs()
+    self.assertLen(errors, 1)
+    self.assertRegex(errors[0], r'has no FAI index at .*ref\.fa\.fai')
+
+  def test_bam_index_locations(self):
+    self._touch('ref.fa', 'ref.fa.fai', 'x.bam')
+    self.assertLen(self._find_missing_inputs(), 1)
+    for index in ['x.bam.bai', 'x.bai', 'x.bam.csi', 'x.csi']:
+      self._touch(index)
+      self.assertEqual(self._find_missing_inputs(), [], index)
+      os.remove(self._path(index))
+
+  def test_cram_index_locations(self):
+    self._touch('ref.fa', 'ref.fa.fai', 'x.cram', 'x.cram.bai')
+    # A BAM index doesn't count for CRAM.
+    errors = self._find_missing_inputs('x.cram')
+    self.assertLen(errors, 1)
+    self.assertIn('x.cram.crai', errors[0])
+    for index in ['x.cram.crai', 'x.crai']:
+      self._touch(index)
+      self.assertEqual(self._find_missing_inputs('x.cram'), [], index)
+      os.remove(self._path(index))
+
+  def test_all_errors_are_reported(self):
+    self._touch('ref.fa', 'x.bam')
+    errors = self._find_missing_inputs()
+    self.assertLen(errors, 2)
+    self.assertIn('FAI index', errors[0])
+    self.assertIn('--reads', errors[1])
+    self.assertLen(self._find_missing_inputs('y.bam'), 2)
+
+
+class PlanOnlyModesTest(absltest.TestCase):
+
+  def setUp(self):
+    super(PlanOnlyModesTest, self).setUp()
+    self.intermediate_results_dir = os.path.join(
+        self.create_tempdir().full_path, 'intermediate')
+    self.flag_values = dict(
+        model_type='WGS',
+        ref='ref.fa',
+        reads='reads.bam',
+        output_vcf='out.vcf',
+        num_shards=4,
+        intermediate_results_dir=self.intermediate_results_dir)
+
+  def test_emit_plan_json_prints_only_json(self):
+    # Overriding a flag set by run_deepvariant logs a warning, which must not
+    # end up in the plan.
+    stdout = _run_main(
+        emit_plan_json=True,
+        make_examples_extra_args='regions=chr20',
+        **self.flag_values)
+    plan = json.loads(stdout)
+    self.assertEqual([step['name'] for step in plan],
+                     ['make_examples', 'call_variants', 'postprocess_variants'])
+    self.assertLen(plan[0]['commands'], 4)
+    self.assertIn('chr20', plan[0]['commands'][0])
+
+  def test_dry_run_prints_one_command_per_line(self):
+    self.flag_values['ref'] = 'my ref.fa'
+    stdout = _run_main(
+        dry_run=True,
+        make_examples_extra_args="regions='chr1 chr2'",
+        **self.flag_values)
+    commands = [shlex.split(line) for line in stdout.splitlines()]
+    # 4 make_examples shards, call_variants and postprocess_variants.
+    self.assertLen(commands, 4 + 2)
+    for task, command in enumerate(commands[:4]):
+      self.assertEqual(command[0], '/opt/deepvariant/bin/make_examples')
+      self.assertEqual(command[command.index('--ref') + 1], 'my ref.fa')
+      self.assertEqual(command[command.index('--regions') + 1], 'chr1 chr2')
+      self.assertEqual(command[-2:], ['--task', str(task)])
+    self.assertEqual(commands[4][0], '/opt/deepvariant/bin/call_variants')
+    self.assertEqual(commands[5][0],
+                     '/opt/deepvariant/bin/postprocess_variants')
+    self.assertFalse(os.path.exists(self.intermediate_results_dir))
+
+
+class MainTest(absltest.TestCase):
+
+  def setUp(self):
+    super(MainTest, self).setUp()
+    tempdir = self.create_tempdir()
+    for name in ['ref.fa', 'ref.fa.fai', 'reads.bam', 'reads.bam.bai']:
+      tempdir.create_file(name)
+    self.tempdir = tempdir.full_path
+    self.flag_values = dict(
+        model_type='WGS',
+        ref=os.path.join(self.tempdir, 'ref.fa'),
+        reads=os.path.join(self.tempdir, 'reads.bam'),
+        output_vcf=os.path.join(self.tempdir, 'out.vcf'),
+        num_shards=2)
+
+  def _run_main_and_get_intermediate_results_dir(self, **flag_values):
+    """Runs main without running the steps and returns the directory used."""
+    intermediate_results_dirs = []
+
+    def fake_run_step(step):
+      if step.name == 'make_examples':
+        # The examples are written to the intermediate results directory.
+        intermediate_results_dirs.append(os.path.dirname(step.outputs[0]))
+        self.assertTrue(os.path.isdir(intermediate_results_dirs[0]))
+
+    with mock.patch.object(run_deepvariant, 'run_step',
+                           side_effect=fake_run_step):
+      _run_main(**dict(self.flag_values, **flag_values))
+    self.assertLen(intermediate_results_dirs, 1)
+    return intermediate_results_dirs[0]
+
+  def test_temporary_intermediate_results_dir_is_removed(self):
+    intermediate_results_dir = (
+        self._run_main_and_get_intermediate_results_dir())
+    self.assertFalse(os.path.exists(intermediate_results_dir))
+
+  def test_given_intermediate_results_dir_is_kept(self):
+    given_dir = os.path.join(self.tempdir, 'intermediate')
+    intermediate_results_dir = self._run_main_and_get_intermediate_results_dir(
+        intermediate_results_dir=given_dir)
+    self.assertEqual(intermediate_results_dir, given_dir)
+    self.assertTrue(os.path.isdir(given_dir))
+
+
+if __name__ == '__main__':
+  absltest.main()